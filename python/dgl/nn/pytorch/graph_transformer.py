@@ -1,9 +1,15 @@
 """Torch modules for graph transformers."""
+import contextlib
+import functools
+import weakref
+
 import torch as th
 import torch.nn as nn
 import torch.nn.functional as F
 import dgl
 
+from ...base import DGLError
+
 __all__ = ["DegreeEncoder", "BiasedMultiheadAttention"]
 
 class DegreeEncoder(nn.Module):
@@ -25,6 +31,14 @@ class DegreeEncoder(nn.Module):
         ``both`` encodes degrees from both directions
         and output the addition of them.
         Default : ``both``.
+    sparse_embedding : bool, optional
+        If True, the gradient of the embedding table is a sparse tensor that
+        only contains the rows of degrees in the input graphs, which speeds up
+        the optimizer step for large ``max_degree`` because degrees are usually
+        heavy-tailed. Only optimizers supporting sparse gradients, such as
+        :class:`torch.optim.SparseAdam` and :class:`torch.optim.SGD`, can be
+        used for the parameters of this module.
+        Default : ``False``.
 
     Example
     -------
@@ -34,23 +48,86 @@ class DegreeEncoder(nn.Module):
     >>> g = dgl.graph(([0,0,0,1,1,2,3,3], [1,2,3,0,3,0,0,1]))
     >>> degree_encoder = DegreeEncoder(5, 16)
     >>> degree_embedding = degree_encoder(g)
+
+    Notes
+    -----
+    The clamped degrees are cached per input graph and reused until its
+    structure is mutated in place, e.g. by :meth:`~dgl.DGLGraph.add_edges`,
+    which saves the degree computation and the conversion of heterogeneous
+    graphs when the same graphs are encoded in every epoch.
     """
 
-    def __init__(self, max_degree, embedding_dim, direction="both"):
+    def __init__(
+        self,
+        max_degree,
+        embedding_dim,
+        direction="both",
+        sparse_embedding=False,
+    ):
         super(DegreeEncoder, self).__init__()
         self.direction = direction
+        # For both directions, a single table is used where out-degrees are
+        # offset by ``max_degree + 1``, so that only one lookup is needed.
+        num_embeddings = max_degree + 1
         if direction == "both":
-            self.degree_encoder_1 = nn.Embedding(
-                max_degree + 1, embedding_dim, padding_idx=0
-            )
-            self.degree_encoder_2 = nn.Embedding(
-                max_degree + 1, embedding_dim, padding_idx=0
-            )
-        else:
-            self.degree_encoder = nn.Embedding(
-                max_degree + 1, embedding_dim, padding_idx=0
-            )
+            num_embeddings *= 2
+        # Rows are padded to a multiple of 8 elements, which allows vectorized
+        # 16-byte memory accesses in the lookup for both float16 and float32
+        # tables. The padding is sliced off in forward.
+        padded_dim = -(-embedding_dim // 8) * 8
+        # Zero degrees are encoded as zero vectors by masking the lookup in
+        # forward rather than with ``padding_idx``, which special-cases the
+        # backward and rewrites the padding row on every update.
+        self.degree_encoder = nn.Embedding(
+            num_embeddings, padded_dim, sparse=sparse_embedding
+        )
+        with th.no_grad():
+            self.degree_encoder.weight[:: max_degree + 1].fill_(0)
+            self.degree_encoder.weight[:, embedding_dim:].fill_(0)
         self.max_degree = max_degree
+        self.embedding_dim = embedding_dim
+        self._degree_cache = weakref.WeakKeyDictionary()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # weak references cannot be pickled
+        del state["_degree_cache"]
+        return state
+
+    def __setstate__(self, state):
+        super(DegreeEncoder, self).__setstate__(state)
+        self._degree_cache = weakref.WeakKeyDictionary()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        """Stitch the separate in-degree and out-degree tables of older
+        checkpoints into the combined table, and pad their rows."""
+        key = f"{prefix}degree_encoder.weight"
+        keys = [f"{prefix}degree_encoder_{i}.weight" for i in (1, 2)]
+        if self.direction == "both" and all(k in state_dict for k in keys):
+            state_dict[key] = th.cat([state_dict.pop(k) for k in keys], dim=0)
+        weight = state_dict.get(key)
+        padded_dim = self.degree_encoder.embedding_dim
+        if weight is not None and weight.shape[-1] < padded_dim:
+            state_dict[key] = F.pad(weight, (0, padded_dim - weight.shape[-1]))
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _degree_index(self, g):
+        """Compute the indices of clamped degrees into the embedding table."""
+        if len(g.ntypes) > 1 or len(g.etypes) > 1:
+            g = dgl.to_homogeneous(g)
+        in_degree = g.in_degrees().clamp_(min=0, max=self.max_degree)
+        out_degree = g.out_degrees().clamp_(min=0, max=self.max_degree)
+
+        if self.direction == "in":
+            return in_degree
+        if self.direction == "out":
+            return out_degree
+        if self.direction == "both":
+            return th.cat([in_degree, out_degree + self.max_degree + 1])
+        raise ValueError(
+            f'Supported direction options: "in", "out" and "both", '
+            f'but got {self.direction}'
+        )
 
     def forward(self, g):
         """
@@ -66,27 +143,93 @@ class DegreeEncoder(nn.Module):
             Return degree embedding vectors of shape :math:`(N, embedding_dim)`,
             where :math:`N` is th number of nodes in the input graph.
         """
-        if len(g.ntypes) > 1 or len(g.etypes) > 1:
-            g = dgl.to_homogeneous(g)
-        in_degree = th.clamp(g.in_degrees(), min=0, max=self.max_degree)
-        out_degree = th.clamp(g.out_degrees(), min=0, max=self.max_degree)
-
-        if self.direction == "in":
-            degree_embedding = self.degree_encoder(in_degree)
-        elif self.direction == "out":
-            degree_embedding = self.degree_encoder(out_degree)
-        elif self.direction == "both":
-            degree_embedding = (self.degree_encoder_1(in_degree)
-                                + self.degree_encoder_2(out_degree))
+        # Reuse the lookup index and zero-degree mask of a seen graph, which
+        # skips the heterogeneity check, the degree computation and the mask
+        # construction. Every in-place mutation of a graph replaces its graph
+        # index, which invalidates the entry.
+        cached = self._degree_cache.get(g)
+        if cached is not None and cached[0] is g._graph:
+            index, nonzero = cached[1:]
         else:
-            raise ValueError(
-                f'Supported direction options: "in", "out" and "both", '
-                f'but got {self.direction}'
+            index = self._degree_index(g)
+            nonzero = (
+                (index % (self.max_degree + 1) != 0)
+                .unsqueeze(-1)
+                .to(self.degree_encoder.weight.dtype)
             )
+            self._degree_cache[g] = (g._graph, index, nonzero)
+
+        degree_embedding = self.degree_encoder(index)[:, : self.embedding_dim]
+        # a no-op cast unless the module dtype changed after caching
+        degree_embedding = degree_embedding * nonzero.to(degree_embedding.dtype)
+        if self.direction == "both":
+            degree_embedding = degree_embedding.view(
+                2, index.shape[0] // 2, -1
+            ).sum(0)
 
         return degree_embedding
 
 
+def _attn_core(
+    q_h,
+    k_h,
+    v_h,
+    attn_bias,
+    attn_mask,
+    attn_bias_type,
+    scaling,
+    dropout,
+    training,
+):
+    """Explicit biased attention on (bsz, num_heads, N, head_dim) queries, keys
+    and values, from the score computation to the weighted sum of values."""
+    bsz, num_heads, N, _ = q_h.shape
+    # Let the GEMM apply the scaling through ``alpha`` and add the additive
+    # bias through ``beta`` instead of running separate elementwise kernels
+    # over its output. With ``beta=0`` the (empty) input is ignored.
+    if attn_bias is not None and attn_bias_type == "add":
+        # ``attn_bias`` may broadcast over heads, so expand before flattening.
+        attn_init = attn_bias.expand(bsz, num_heads, N, N).reshape(
+            bsz * num_heads, N, N
+        )
+        beta = 1
+    else:
+        attn_init, beta = q_h.new_empty(()), 0
+    attn_weights = th.baddbmm(
+        attn_init,
+        q_h.flatten(0, 1),
+        k_h.flatten(0, 1).transpose(1, 2),
+        beta=beta,
+        alpha=scaling,
+    ).view(bsz, num_heads, N, N)
+
+    if attn_bias is not None and attn_bias_type == "mul":
+        attn_weights *= attn_bias
+
+    if attn_mask is not None:
+        # Broadcast the mask over heads. A large finite value instead of -inf
+        # keeps fully masked rows free of NaN, also in reduced precision.
+        attn_weights.masked_fill_(
+            attn_mask.to(th.bool).unsqueeze(1),
+            th.finfo(attn_weights.dtype).min / 2,
+        )
+
+    attn_weights = F.softmax(attn_weights, dim=-1)
+
+    # no dropout kernel at inference
+    if training and dropout > 0:
+        attn_weights = F.dropout(attn_weights, p=dropout)
+
+    return th.matmul(attn_weights, v_h)
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_attn_core():
+    """Compile :func:`_attn_core` on first use, so that TorchInductor fuses its
+    elementwise operations on attention weights."""
+    return th.compile(_attn_core, dynamic=True)
+
+
 class BiasedMultiheadAttention(nn.Module):
     r"""Dense Multi-Head Attention Module with Graph Attention Bias.
 
@@ -102,6 +245,13 @@ class BiasedMultiheadAttention(nn.Module):
     is the corresponding :attr:`feat_size`. :math:`b` is attention bias, which
     can be additive or multiplicative according to the operator :math:`\circ`.
 
+    With PyTorch 2.0 or later, additive attention bias is handled by
+    :func:`torch.nn.functional.scaled_dot_product_attention`. The bias and mask
+    are passed to it as a float attention mask, which FlashAttention does not
+    support, so it dispatches to the memory-efficient kernel when one is
+    available, or otherwise to the math implementation. Only without both
+    bias and mask can it dispatch to FlashAttention.
+
     Parameters
     ----------
     feat_size : int
@@ -118,6 +268,48 @@ class BiasedMultiheadAttention(nn.Module):
         * 'mul' is for multiplicative attention bias.
     attn_drop : float, optional
         Dropout probability on attention weights. Defalt: 0.1.
+    fuse_qkv : bool, optional
+        If True, the query, key and value projections are computed by a single
+        linear layer of output size ``3 * feat_size``, which runs one large
+        matrix multiplication instead of three. Checkpoints saved with separate
+        ``q_proj``, ``k_proj`` and ``v_proj`` layers can still be loaded.
+        Default: True.
+    autocast_dtype : torch.dtype, optional
+        If given, e.g. ``torch.bfloat16`` or ``torch.float16``, the linear
+        projections and attention matrix multiplications run under
+        :class:`torch.autocast` with this dtype. This includes the output
+        projection, so the output is of this dtype rather than that of the
+        input. Masked attention weights are filled with a large finite
+        negative value of the reduced dtype, so they cannot overflow, and
+        softmax follows the precision policy of autocast. Default: None.
+
+        .. note::
+
+            On Ampere or newer GPUs, float32 matrix multiplications can also
+            use TF32 tensor cores by setting
+            ``torch.backends.cuda.matmul.allow_tf32 = True``.
+    bias_layout : str, optional
+        The layout of :attr:`attn_bias` passed to :meth:`forward`. Selected from
+        'bnnh', 'bhnn' or 'flat'. Default: 'bnnh'.
+
+        * 'bnnh' is for shape (batch_size, N, N, :attr:`num_heads`), which is
+          permuted to the attention layout in every forward pass.
+        * 'bhnn' is for shape (batch_size, :attr:`num_heads`, N, N), the layout
+          of attention weights, which is used as is. Graph attention biases
+          such as spatial and edge encodings are static per graph, so they can
+          be stored in this layout once during data preprocessing.
+        * 'flat' is for shape (batch_size * :attr:`num_heads`, N, N), the
+          layout of the batched matrix multiplication computing attention
+          weights, which is only viewed as the 'bhnn' layout.
+    use_compile : bool, optional
+        If True, the attention computation that materializes attention weights
+        is compiled with :func:`torch.compile`, which fuses the scaling,
+        biasing, masking, softmax and dropout of attention weights into fewer
+        kernels. It is used for multiplicative attention bias, or when
+        :func:`torch.nn.functional.scaled_dot_product_attention` is not
+        available. The projections are not compiled, so that varying batch
+        sizes do not trigger recompilation of them. Requires PyTorch 2.0 or
+        later. Default: False.
 
     Examples
     --------
@@ -128,9 +320,27 @@ class BiasedMultiheadAttention(nn.Module):
     >>> bias = th.rand(16, 100, 100, 8)
     >>> net = BiasedMultiheadAttention(feat_size=512, num_heads=8)
     >>> out = net(ndata, bias)
+
+    With additive attention bias, a mask shared by a stack of attention layers
+    can be merged into the bias once instead of being applied by every layer.
+
+    >>> mask = th.rand(16, 100, 100) < 0.1
+    >>> bias = net.merge_mask_into_bias(bias, mask)
+    >>> out = net(ndata, bias)
     """
 
-    def __init__(self, feat_size, num_heads, bias=True, attn_bias_type="add", attn_drop=0.1):
+    def __init__(
+        self,
+        feat_size,
+        num_heads,
+        bias=True,
+        attn_bias_type="add",
+        attn_drop=0.1,
+        fuse_qkv=True,
+        autocast_dtype=None,
+        bias_layout="bnnh",
+        use_compile=False,
+    ):
         super().__init__()
         self.feat_size = feat_size
         self.num_heads = num_heads
@@ -140,10 +350,24 @@ class BiasedMultiheadAttention(nn.Module):
         ), "feat_size must be divisible by num_heads"
         self.scaling = self.head_dim**-0.5
         self.attn_bias_type = attn_bias_type
+        self.fuse_qkv = fuse_qkv
+        self.autocast_dtype = autocast_dtype
+        if bias_layout not in ("bnnh", "bhnn", "flat"):
+            raise ValueError(
+                f'Supported bias layouts: "bnnh", "bhnn" and "flat", '
+                f"but got {bias_layout}"
+            )
+        self.bias_layout = bias_layout
+        if use_compile and not hasattr(th, "compile"):
+            raise DGLError("use_compile requires PyTorch 2.0 or later.")
+        self.use_compile = use_compile
 
-        self.q_proj = nn.Linear(feat_size, feat_size, bias=bias)
-        self.k_proj = nn.Linear(feat_size, feat_size, bias=bias)
-        self.v_proj = nn.Linear(feat_size, feat_size, bias=bias)
+        if fuse_qkv:
+            self.qkv_proj = nn.Linear(feat_size, 3 * feat_size, bias=bias)
+        else:
+            self.q_proj = nn.Linear(feat_size, feat_size, bias=bias)
+            self.k_proj = nn.Linear(feat_size, feat_size, bias=bias)
+            self.v_proj = nn.Linear(feat_size, feat_size, bias=bias)
         self.out_proj = nn.Linear(feat_size, feat_size, bias=bias)
 
         self.dropout = nn.Dropout(p=attn_drop)
@@ -153,14 +377,121 @@ class BiasedMultiheadAttention(nn.Module):
     def reset_parameters(self):
         """Reset parameters of projection matrices, the same settings as that in Graphormer.
         """
-        nn.init.xavier_uniform_(self.q_proj.weight, gain=2**-0.5)
-        nn.init.xavier_uniform_(self.k_proj.weight, gain=2**-0.5)
-        nn.init.xavier_uniform_(self.v_proj.weight, gain=2**-0.5)
+        if self.fuse_qkv:
+            # Initialize the query, key and value blocks separately so that
+            # the fan-in/fan-out match those of the unfused projections.
+            for weight in self.qkv_proj.weight.chunk(3, dim=0):
+                nn.init.xavier_uniform_(weight, gain=2**-0.5)
+        else:
+            nn.init.xavier_uniform_(self.q_proj.weight, gain=2**-0.5)
+            nn.init.xavier_uniform_(self.k_proj.weight, gain=2**-0.5)
+            nn.init.xavier_uniform_(self.v_proj.weight, gain=2**-0.5)
 
         nn.init.xavier_uniform_(self.out_proj.weight)
         if self.out_proj.bias is not None:
             nn.init.constant_(self.out_proj.bias, 0.0)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        """Convert between fused and separate query/key/value projection
+        parameters so that checkpoints of either layout can be loaded."""
+        names = ["q_proj", "k_proj", "v_proj"]
+        for param in ["weight", "bias"]:
+            fused_key = f"{prefix}qkv_proj.{param}"
+            keys = [f"{prefix}{name}.{param}" for name in names]
+            if self.fuse_qkv and all(key in state_dict for key in keys):
+                state_dict[fused_key] = th.cat(
+                    [state_dict.pop(key) for key in keys], dim=0
+                )
+            elif not self.fuse_qkv and fused_key in state_dict:
+                for key, value in zip(
+                    keys, state_dict.pop(fused_key).chunk(3, dim=0)
+                ):
+                    state_dict[key] = value
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def merge_mask_into_bias(self, attn_bias, attn_mask):
+        """Merge an attention mask into an additive attention bias.
+
+        Masked positions of the returned bias are set to half of the minimum
+        value of :attr:`autocast_dtype` if given, or of the bias dtype
+        otherwise, so that the value does not overflow when autocast lowers
+        the bias in :meth:`forward`. Passing it alone to :meth:`forward` is
+        equivalent to passing both :attr:`attn_bias` and :attr:`attn_mask`,
+        while the mask is only processed once for all layers that share it.
+
+        Parameters
+        ----------
+        attn_bias : torch.Tensor
+            The additive attention bias in the layout given by
+            :attr:`bias_layout`.
+        attn_mask : torch.Tensor
+            The attention mask, where invalid positions are indicated by
+            non-zero values. Shape: (batch_size, N, N).
+
+        Returns
+        -------
+        torch.Tensor
+            The attention bias with the mask merged, in the same layout as
+            :attr:`attn_bias`.
+
+        Raises
+        ------
+        DGLError
+            If :attr:`attn_bias_type` is not 'add'.
+        """
+        if self.attn_bias_type != "add":
+            raise DGLError(
+                "Only additive attention bias can be merged with an attention "
+                f"mask, but got attn_bias_type {self.attn_bias_type}."
+            )
+        attn_mask = attn_mask.to(th.bool)
+        masked_value = th.finfo(self.autocast_dtype or attn_bias.dtype).min / 2
+        if self.bias_layout == "bnnh":
+            return attn_bias.masked_fill(attn_mask.unsqueeze(-1), masked_value)
+        if self.bias_layout == "bhnn":
+            return attn_bias.masked_fill(attn_mask.unsqueeze(1), masked_value)
+        bsz, N, _ = attn_mask.shape
+        return (
+            attn_bias.view(bsz, self.num_heads, N, N)
+            .masked_fill(attn_mask.unsqueeze(1), masked_value)
+            .view_as(attn_bias)
+        )
+
+    def preload_bias(self, attn_bias, stream=None):
+        """Copy an attention bias to the device of this module ahead of time.
+
+        Attention biases are usually shared by all layers of a model, so they
+        should be moved to the device once per batch rather than by every
+        layer. CPU tensors are pinned first so that the copy is asynchronous.
+
+        Parameters
+        ----------
+        attn_bias : torch.Tensor
+            The attention bias to copy.
+        stream : torch.cuda.Stream, optional
+            A side CUDA stream to issue the copy on, so that it overlaps with
+            the computation on the current stream. The current stream must
+            wait for it before the bias is used, e.g. with
+            ``torch.cuda.current_stream().wait_stream(stream)``.
+
+        Returns
+        -------
+        torch.Tensor
+            The attention bias on the device of this module.
+        """
+        device = self.out_proj.weight.device
+        if attn_bias.device == device or device.type != "cuda":
+            return attn_bias.to(device)
+        if attn_bias.device.type == "cpu":
+            attn_bias = attn_bias.pin_memory()
+        if stream is None:
+            return attn_bias.to(device, non_blocking=True)
+        with th.cuda.stream(stream):
+            attn_bias = attn_bias.to(device, non_blocking=True)
+        # the bias is allocated on the side stream but used on the current one
+        attn_bias.record_stream(th.cuda.current_stream(device))
+        return attn_bias
+
     def forward(self, ndata, attn_bias=None, attn_mask=None):
         """Forward computation.
 
@@ -171,51 +502,124 @@ class BiasedMultiheadAttention(nn.Module):
             N is the maximum number of nodes.
         attn_bias : torch.Tensor, optional
             The attention bias used for attention modification. Shape:
-            (batch_size, N, N, :attr:`num_heads`).
+            (batch_size, N, N, :attr:`num_heads`),
+            (batch_size, :attr:`num_heads`, N, N) if :attr:`bias_layout` is
+            'bhnn', or (batch_size * :attr:`num_heads`, N, N) if it is 'flat'.
         attn_mask : torch.Tensor, optional
             The attention mask used for avoiding computation on invalid positions, where
             invalid positions are indicated by non-zero values. Shape: (batch_size, N, N).
+            For additive attention bias, it can instead be merged into
+            :attr:`attn_bias` once per batch with :meth:`merge_mask_into_bias`.
 
         Returns
         -------
         y : torch.Tensor
             The output tensor. Shape: (batch_size, N, :attr:`feat_size`)
+
+        Raises
+        ------
+        DGLError
+            If :attr:`attn_bias` or :attr:`attn_mask` is not on the device of
+            :attr:`ndata`. Note that this also applies to :attr:`attn_mask`,
+            so a CPU mask is no longer accepted together with CUDA
+            :attr:`ndata`. Move both to the device once for all layers, e.g.
+            with :meth:`preload_bias`.
         """
-        q_h = self.q_proj(ndata).transpose(0, 1)
-        k_h = self.k_proj(ndata).transpose(0, 1)
-        v_h = self.v_proj(ndata).transpose(0, 1)
-        bsz, N, _ = ndata.shape
-        q_h = q_h.reshape(N, bsz * self.num_heads, self.head_dim).transpose(0, 1) / self.scaling
-        k_h = k_h.reshape(N, bsz * self.num_heads, self.head_dim).permute(1, 2, 0)
-        v_h = v_h.reshape(N, bsz * self.num_heads, self.head_dim).transpose(0, 1)
-
-        attn_weights = (
-            th.bmm(q_h, k_h)
-            .transpose(0, 2)
-            .reshape(N, N, bsz, self.num_heads)
-            .transpose(0, 2)
+        inputs = {"attn_bias": attn_bias, "attn_mask": attn_mask}
+        for name, tensor in inputs.items():
+            if tensor is not None and tensor.device != ndata.device:
+                raise DGLError(
+                    f"Expect {name} on device {ndata.device}, but got "
+                    f"{tensor.device}. Move it to the device once for all "
+                    "layers, e.g. with preload_bias() or "
+                    "pin_memory().to(device, non_blocking=True)."
+                )
+
+        # A null context instead of a disabled autocast, which would also
+        # turn off the autocast of callers.
+        autocast = (
+            th.autocast(ndata.device.type, dtype=self.autocast_dtype)
+            if self.autocast_dtype is not None
+            else contextlib.nullcontext()
         )
-
-        if attn_bias is not None:
-            if self.attn_bias_type == "add":
-                attn_weights += attn_bias
+        with autocast:
+            bsz, N, _ = ndata.shape
+            # Keep the projection inputs and outputs contiguous so that the
+            # linear layers run on the ``addmm`` fast path, then move the
+            # projections into the (bsz, num_heads, N, head_dim) layout used by
+            # the rest of the computation with a single permutation.
+            if self.fuse_qkv:
+                q_h, k_h, v_h = (
+                    self.qkv_proj(ndata)
+                    .view(bsz, N, 3, self.num_heads, self.head_dim)
+                    .permute(2, 0, 3, 1, 4)
+                    .contiguous()
+                    .unbind(dim=0)
+                )
             else:
-                attn_weights *= attn_bias
-
-        if attn_mask is not None:
-            attn_weights[attn_mask.to(th.bool)] = float("-inf")
-
-        attn_weights = F.softmax(
-            attn_weights.transpose(0, 2)
-            .reshape(N, N, bsz * self.num_heads)
-            .transpose(0, 2),
-            dim=2,
-        )
-
-        attn_weights = self.dropout(attn_weights)
-
-        attn = th.bmm(attn_weights, v_h).transpose(0, 1)
-
-        attn = self.out_proj(attn.reshape(N, bsz, self.feat_size).transpose(0, 1))
+                q_h, k_h, v_h = [
+                    proj(ndata)
+                    .view(bsz, N, self.num_heads, self.head_dim)
+                    .transpose(1, 2)
+                    .contiguous()
+                    for proj in (self.q_proj, self.k_proj, self.v_proj)
+                ]
+
+            if attn_bias is not None and self.bias_layout == "bnnh":
+                attn_bias = attn_bias.permute(0, 3, 1, 2)
+            elif attn_bias is not None and self.bias_layout == "flat":
+                attn_bias = attn_bias.view(bsz, self.num_heads, N, N)
+
+            if hasattr(F, "scaled_dot_product_attention") and (
+                attn_bias is None or self.attn_bias_type == "add"
+            ):
+                # Fused attention kernel, which does not materialize the
+                # attention weights unless it falls back to the math backend.
+                # The additive bias and the mask are folded into a single
+                # float mask, which rules out the FlashAttention backend.
+                # Without bias and mask, e.g. at inference, it reduces to plain
+                # attention of either bias type with no dropout.
+                if attn_mask is not None:
+                    attn_mask = attn_mask.to(th.bool).unsqueeze(1)
+                    # A float mask instead of a boolean one, which SDPA turns
+                    # into -inf. Take the masked value from the query dtype,
+                    # which autocast may have lowered, so that it does not
+                    # overflow when the mask is cast to that dtype.
+                    masked_value = th.finfo(q_h.dtype).min / 2
+                    if attn_bias is None:
+                        attn_bias = q_h.new_zeros(attn_mask.shape).masked_fill_(
+                            attn_mask, masked_value
+                        )
+                    else:
+                        attn_bias = attn_bias.masked_fill(
+                            attn_mask, masked_value
+                        )
+                attn = F.scaled_dot_product_attention(
+                    q_h,
+                    k_h,
+                    v_h,
+                    attn_mask=attn_bias,
+                    dropout_p=self.dropout.p if self.training else 0.0,
+                    is_causal=False,
+                )
+            else:
+                attn_core = (
+                    _compiled_attn_core() if self.use_compile else _attn_core
+                )
+                attn = attn_core(
+                    q_h,
+                    k_h,
+                    v_h,
+                    attn_bias,
+                    attn_mask,
+                    self.attn_bias_type,
+                    self.scaling,
+                    self.dropout.p,
+                    self.training,
+                )
+
+            # (bsz, num_heads, N, head_dim) -> (bsz, N, feat_size)
+            attn = attn.transpose(1, 2).reshape(bsz, N, self.feat_size)
+            attn = self.out_proj(attn)
 
         return attn
@@ -1733,7 +1733,7 @@ def test_DeepWalk():
     optim.step()
 
 @pytest.mark.parametrize('max_degree', [2, 6])
-@pytest.mark.parametrize('embedding_dim', [8, 16])
+@pytest.mark.parametrize('embedding_dim', [5, 8, 16])
 @pytest.mark.parametrize('direction', ['in', 'out', 'both'])
 def test_degree_encoder(max_degree, embedding_dim, direction):
     g = dgl.graph((
@@ -1751,6 +1751,38 @@ def test_degree_encoder(max_degree, embedding_dim, direction):
     de_hg = model(hg)
     assert de_g.shape == (4, embedding_dim)
     assert de_hg.shape == (10, embedding_dim)
+    # encoding a seen graph reuses its cached degrees
+    assert th.equal(model(hg), de_hg)
+
+    # in-place mutations keeping the numbers of nodes and edges invalidate it
+    g.remove_edges(th.tensor([0]))
+    g.add_edges(th.tensor([2]), th.tensor([2]))
+    fresh_model = nn.DegreeEncoder(max_degree, embedding_dim, direction=direction)
+    fresh_model.load_state_dict(model.state_dict())
+    assert th.equal(model(g), fresh_model(g))
+
+    if direction == 'both':
+        # checkpoints with separate in/out-degree tables can still be loaded
+        weights = th.randn(2, max_degree + 1, embedding_dim)
+        model.load_state_dict({
+            'degree_encoder_1.weight': weights[0],
+            'degree_encoder_2.weight': weights[1]
+        })
+        in_degree = th.clamp(g.in_degrees(), max=max_degree)
+        out_degree = th.clamp(g.out_degrees(), max=max_degree)
+        assert th.allclose(model(g), weights[0][in_degree] + weights[1][out_degree])
+
+@pytest.mark.parametrize('direction', ['in', 'out', 'both'])
+def test_degree_encoder_sparse(direction):
+    g = dgl.graph((
+        th.tensor([0, 0, 0, 1, 1, 2, 3, 3]),
+        th.tensor([1, 2, 3, 0, 3, 0, 0, 1])
+    ))
+    model = nn.DegreeEncoder(16, 8, direction=direction, sparse_embedding=True)
+    optim = th.optim.SparseAdam(model.parameters(), lr=0.01)
+    model(g).sum().backward()
+    assert model.degree_encoder.weight.grad.is_sparse
+    optim.step()
 
 @parametrize_idtype
 def test_MetaPath2Vec(idtype):
@@ -1801,3 +1833,179 @@ def test_BiasedMultiheadAttention(feat_size, num_heads, bias, attn_bias_type, at
     out = net(ndata, attn_bias, attn_mask)
 
     assert out.shape == (16, 100, feat_size)
+
+@pytest.mark.parametrize('bias', [True, False])
+def test_BiasedMultiheadAttention_fuse_qkv(bias):
+    ndata = th.rand(4, 10, 32)
+    attn_bias = th.rand(4, 10, 10, 4)
+
+    net = nn.BiasedMultiheadAttention(32, 4, bias, fuse_qkv=False).eval()
+    fused_net = nn.BiasedMultiheadAttention(32, 4, bias, fuse_qkv=True).eval()
+    # checkpoints with separate q/k/v projections load into the fused layout
+    fused_net.load_state_dict(net.state_dict())
+
+    assert th.allclose(net(ndata, attn_bias), fused_net(ndata, attn_bias), atol=1e-6)
+
+@pytest.mark.parametrize('attn_bias_type', ['add', 'mul'])
+def test_BiasedMultiheadAttention_bias_layout(attn_bias_type):
+    ndata = th.rand(4, 10, 32)
+    attn_bias = th.rand(4, 10, 10, 4)
+    attn_mask = th.rand(4, 10, 10) < 0.5
+
+    net = nn.BiasedMultiheadAttention(32, 4, attn_bias_type=attn_bias_type).eval()
+    bhnn_net = nn.BiasedMultiheadAttention(
+        32, 4, attn_bias_type=attn_bias_type, bias_layout='bhnn').eval()
+    flat_net = nn.BiasedMultiheadAttention(
+        32, 4, attn_bias_type=attn_bias_type, bias_layout='flat').eval()
+    bhnn_net.load_state_dict(net.state_dict())
+    flat_net.load_state_dict(net.state_dict())
+
+    out = net(ndata, attn_bias, attn_mask)
+    bhnn_bias = attn_bias.permute(0, 3, 1, 2)
+    bhnn_out = bhnn_net(ndata, bhnn_bias, attn_mask)
+    flat_out = flat_net(ndata, bhnn_bias.reshape(16, 10, 10), attn_mask)
+    assert th.allclose(out, bhnn_out, atol=1e-6)
+    assert th.allclose(out, flat_out, atol=1e-6)
+
+@pytest.mark.parametrize('autocast_dtype', [None, th.bfloat16, th.float16])
+def test_BiasedMultiheadAttention_merge_mask(autocast_dtype):
+    ndata = th.rand(4, 10, 32)
+    attn_bias = th.rand(4, 10, 10, 4)
+    attn_mask = th.rand(4, 10, 10) < 0.5
+    attn_mask[:, 0] = True
+
+    net = nn.BiasedMultiheadAttention(
+        32, 4, autocast_dtype=autocast_dtype).eval()
+    out = net(ndata, attn_bias, attn_mask)
+    merged_out = net(ndata, net.merge_mask_into_bias(attn_bias, attn_mask))
+    assert th.allclose(out, merged_out, atol=1e-6)
+
+    mul_net = nn.BiasedMultiheadAttention(32, 4, attn_bias_type='mul')
+    with pytest.raises(dgl.DGLError):
+        mul_net.merge_mask_into_bias(attn_bias, attn_mask)
+
+def test_BiasedMultiheadAttention_inference(monkeypatch):
+    from dgl.nn.pytorch import graph_transformer
+    calls = []
+    dropout = graph_transformer.F.dropout
+    def counting_dropout(*args, **kwargs):
+        calls.append(kwargs.get('p'))
+        return dropout(*args, **kwargs)
+    monkeypatch.setattr(graph_transformer.F, 'dropout', counting_dropout)
+
+    ndata = th.rand(4, 10, 32)
+    attn_bias = th.rand(4, 10, 10, 4)
+    net = nn.BiasedMultiheadAttention(
+        32, 4, attn_bias_type='mul', attn_drop=0.5)
+    # no dropout is applied at inference
+    net.eval()(ndata, attn_bias)
+    assert calls == []
+    # nor without dropout probability
+    no_drop_net = nn.BiasedMultiheadAttention(
+        32, 4, attn_bias_type='mul', attn_drop=0.)
+    no_drop_net.train()(ndata, attn_bias)
+    assert calls == []
+    net.train()(ndata, attn_bias)
+    assert calls == [0.5]
+
+def test_BiasedMultiheadAttention_full_mask():
+    ndata = th.rand(4, 10, 32)
+    attn_mask = th.rand(4, 10, 10) < 0.5
+    # fully masked rows
+    attn_mask[:, 0] = True
+
+    net = nn.BiasedMultiheadAttention(32, 4).eval()
+    mul_net = nn.BiasedMultiheadAttention(32, 4, attn_bias_type='mul').eval()
+    mul_net.load_state_dict(net.state_dict())
+
+    out = net(ndata, None, attn_mask)
+    add_out = net(ndata, th.zeros(4, 10, 10, 4), attn_mask)
+    mul_out = mul_net(ndata, th.ones(4, 10, 10, 4), attn_mask)
+    assert not th.isnan(out).any()
+    assert th.allclose(out, add_out, atol=1e-6)
+    assert th.allclose(out, mul_out, atol=1e-6)
+
+@pytest.mark.parametrize('attn_bias_type', ['add', 'mul'])
+@pytest.mark.parametrize('autocast_dtype', [th.bfloat16, th.float16])
+def test_BiasedMultiheadAttention_autocast(attn_bias_type, autocast_dtype):
+    ndata = th.rand(4, 10, 32)
+    attn_bias = th.rand(4, 10, 10, 4)
+    attn_mask = th.rand(4, 10, 10) < 0.5
+    attn_mask[:, 0] = True
+
+    net = nn.BiasedMultiheadAttention(
+        32, 4, attn_bias_type=attn_bias_type).eval()
+    autocast_net = nn.BiasedMultiheadAttention(
+        32, 4, attn_bias_type=attn_bias_type,
+        autocast_dtype=autocast_dtype).eval()
+    autocast_net.load_state_dict(net.state_dict())
+
+    out = net(ndata, attn_bias, attn_mask)
+    autocast_out = autocast_net(ndata, attn_bias, attn_mask)
+    assert autocast_out.dtype == autocast_dtype
+    assert not th.isnan(autocast_out).any()
+    assert th.allclose(out, autocast_out.float(), atol=5e-2)
+
+def test_BiasedMultiheadAttention_device():
+    ndata = th.rand(4, 10, 32)
+    attn_bias = th.rand(4, 10, 10, 4)
+    attn_mask = th.rand(4, 10, 10) < 0.5
+
+    net = nn.BiasedMultiheadAttention(32, 4).eval()
+    assert net.preload_bias(attn_bias) is attn_bias
+    # the meta device stands in for any device other than that of ndata
+    with pytest.raises(dgl.DGLError):
+        net(ndata, attn_bias.to('meta'), attn_mask)
+    with pytest.raises(dgl.DGLError):
+        net(ndata, attn_bias, attn_mask.to('meta'))
+
+@pytest.mark.skipif(not th.cuda.is_available(), reason='requires CUDA')
+def test_BiasedMultiheadAttention_preload_bias_stream():
+    ndata = th.rand(4, 10, 32).cuda()
+    attn_bias = th.rand(4, 10, 10, 4)
+
+    net = nn.BiasedMultiheadAttention(32, 4).cuda().eval()
+    stream = th.cuda.Stream()
+    preloaded_bias = net.preload_bias(attn_bias, stream=stream)
+    th.cuda.current_stream().wait_stream(stream)
+    assert preloaded_bias.device == ndata.device
+    assert th.allclose(
+        net(ndata, preloaded_bias), net(ndata, attn_bias.cuda()), atol=1e-6)
+
+@pytest.mark.skipif(not hasattr(th, 'compile'),
+                    reason='requires torch.compile')
+def test_BiasedMultiheadAttention_compile():
+    ndata = th.rand(4, 10, 32)
+    attn_bias = th.rand(4, 10, 10, 4)
+    attn_mask = th.rand(4, 10, 10) < 0.5
+
+    net = nn.BiasedMultiheadAttention(32, 4, attn_bias_type='mul').eval()
+    compiled_net = nn.BiasedMultiheadAttention(
+        32, 4, attn_bias_type='mul', use_compile=True).eval()
+    compiled_net.load_state_dict(net.state_dict())
+    assert th.allclose(
+        compiled_net(ndata, attn_bias, attn_mask),
+        net(ndata, attn_bias, attn_mask), atol=1e-6)
+
+@pytest.mark.parametrize('bias_shape', [(4, 4, 10, 10), (4, 1, 10, 10)])
+def test_BiasedMultiheadAttention_attn_core(bias_shape):
+    from dgl.nn.pytorch.graph_transformer import _attn_core
+    q_h, k_h, v_h = th.rand(3, 4, 4, 10, 8).unbind(0)
+    attn_bias = th.rand(bias_shape)
+    attn_mask = th.rand(4, 10, 10) < 0.5
+    attn_mask[:, :, 0] = False
+
+    out = _attn_core(q_h, k_h, v_h, attn_bias, attn_mask, 'add',
+                     8 ** -0.5, 0.0, False)
+    sdpa_mask = attn_bias.masked_fill(attn_mask.unsqueeze(1), float('-inf'))
+    expected = th.nn.functional.scaled_dot_product_attention(
+        q_h, k_h, v_h, attn_mask=sdpa_mask)
+    assert th.allclose(out, expected, atol=1e-6)
+
+    # a bias broadcasting over heads goes through the same path in forward
+    ndata = th.rand(4, 10, 32)
+    net = nn.BiasedMultiheadAttention(32, 4, attn_bias_type='mul').eval()
+    bias = th.rand(4, 10, 10, 1)
+    assert th.allclose(net(ndata, bias, attn_mask),
+                       net(ndata, bias.expand(-1, -1, -1, 4), attn_mask),
+                       atol=1e-6)